@@ -1,15 +1,27 @@
 from __future__ import print_function
 import os
+import stat
 import subprocess
 import sys
-import textwrap
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
 
 from tracing import Tracing
 from buck_tool import BuckTool, JAVA_MAX_HEAP_SIZE_MB, platform_path
 from buck_tool import BuckToolException, RestartBuck
-from subprocutils import check_output, which
+from subprocutils import which
 import buck_version
 
+try:
+    _read_input = raw_input
+except NameError:
+    # Python 3 renamed raw_input to input.
+    _read_input = input
+
 # If you're looking for JAVA_CLASSPATHS, they're now defined in the programs/classpaths file.
 
 RESOURCES = {
@@ -37,52 +49,165 @@ RESOURCES = {
     "path_to_typing": "third-party/py/typing/python2",
 }
 
+# RESOURCES with the paths already split into their components.
+_RESOURCES_SPLIT = dict(
+    (name, tuple(path.split('/'))) for name, path in RESOURCES.items())
+
+
+# Results of looking up executables on $PATH, shared by all BuckRepo instances.
+_which_cache = {}
+
+
+def _which_cached(cmd):
+    if cmd not in _which_cache:
+        _which_cache[cmd] = which(cmd)
+    return _which_cache[cmd]
+
+
+def _set_close_on_exec(f):
+    # Python 2 leaves pipe descriptors inheritable, so without this every
+    # process spawned from here on would hold them open.
+    if fcntl is not None:
+        flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def _parse_batch_check_line(line):
+    """Returns the object name from a 'git cat-file --batch-check' output line,
+    or None if the object is missing or ambiguous.
+    """
+    # Each line is either "<sha> <type> <size>" or "<name> missing|ambiguous".
+    fields = line.split()
+    if len(fields) == 3:
+        return fields[0]
+    return None
+
+
+def _inspect_buck_dir(buck_dir):
+    """Returns (has_dot_git, is_built, may_have_fake_buck_version_file) for the
+    buck checkout at `buck_dir`.
+    """
+    # Stat-ing the two paths we need is cheaper than listing the directory
+    # without os.scandir, which the Python 2 launcher doesn't have.
+    try:
+        has_dot_git = stat.S_ISDIR(os.stat(os.path.join(buck_dir, '.git')).st_mode)
+    except OSError:
+        has_dot_git = False
+    try:
+        os.stat(os.path.join(buck_dir, 'build', 'successful-build'))
+        is_built = True
+    except OSError:
+        is_built = False
+    # Trying to open .fakebuckversion is what tells us whether it exists.
+    return has_dot_git, is_built, True
+
 
 def get_ant_env(max_heap_size_mb):
+    ant_opts = os.environ.get('ANT_OPTS', '')
+    if '-Xmx' in ant_opts:
+        # The max heap size is already specified, so the environment can be
+        # used as is.
+        return os.environ
+    # Adjust the max heap size if it's not already specified.
+    ant_max_heap_arg = '-Xmx{0}m'.format(max_heap_size_mb)
+    if ant_opts:
+        ant_opts += ' '
+    ant_opts += ant_max_heap_arg
     ant_env = os.environ.copy()
-    ant_opts = ant_env.get('ANT_OPTS', '')
-    if ant_opts.find('-Xmx') == -1:
-        # Adjust the max heap size if it's not already specified.
-        ant_max_heap_arg = '-Xmx{0}m'.format(max_heap_size_mb)
-        if ant_opts:
-            ant_opts += ' '
-        ant_opts += ant_max_heap_arg
-        ant_env['ANT_OPTS'] = ant_opts
+    ant_env['ANT_OPTS'] = ant_opts
     return ant_env
 
 
+_MSG_REVISION_MISSING = """\
+Required revision {0} is not
+available in the local repository.
+Buck is fetching updates from git. You can disable this by creating
+a '.nobuckcheck' file in your repository, but this might lead to
+strange bugs or build failures."""
+
+_MSG_FETCH_FAILED = "Failed to fetch Buck updates from git."
+
+_MSG_UPDATING = """\
+Buck is at {0}, but should be {1}.
+Buck is updating itself. To disable this, add a '.nobuckcheck'
+file to your project root. In general, you should only disable
+this if you are developing Buck."""
+
+_MSG_CHECKOUT_FAILED = "Failed to update Buck to revision {0}."
+
+_MSG_ANT_FAILED = """\
+::: 'ant' failed in the buck repo at '{0}',
+::: and 'buck' is not properly built. It will be unusable
+::: until the error is corrected. You can check the logs
+::: at {1} to figure out what broke."""
+
+_MSG_FIX_WITH_GIT_CLEAN = """\
+::: It is possible that running this command will fix it:
+::: git -C "{0}" clean -xfd"""
+
+_MSG_FIX_WITH_RM_BUILD = """\
+::: It is possible that running this command will fix it:
+::: rm -rf "{0}"/build"""
+
+_MSG_LOCAL_MODIFICATIONS = """\
+::: Your buck directory has local modifications, and therefore
+::: builds will not be able to use a distributed cache.
+::: The following files must be either reverted or committed:"""
+
+_MSG_DIRTY = """\
+::: Your local buck directory is dirty, and therefore builds will
+::: not be able to use a distributed cache."""
+
+
 class BuckRepo(BuckTool):
 
     def __init__(self, buck_bin_dir, buck_project):
         super(BuckRepo, self).__init__(buck_project)
 
         self._buck_dir = platform_path(os.path.dirname(buck_bin_dir))
+        self._buck_dir_paths = {}
+        self._ant_env = None
         self._build_success_file = os.path.join(
             self._buck_dir, "build", "successful-build")
 
-        dot_git = os.path.join(self._buck_dir, '.git')
-        self._is_git = os.path.exists(dot_git) and os.path.isdir(dot_git) and which('git') and \
-            sys.platform != 'cygwin'
+        has_dot_git, self._is_built, self._may_have_fake_buck_version_file = \
+            _inspect_buck_dir(self._buck_dir)
+        self._is_git = has_dot_git and _which_cached('git') and sys.platform != 'cygwin'
         self._is_buck_repo_dirty_override = os.environ.get('BUCK_REPOSITORY_DIRTY')
 
-        buck_version = buck_project.buck_version
-        if self._is_git and not buck_project.has_no_buck_check and buck_version:
-            revision = buck_version[0]
-            branch = buck_version[1] if len(buck_version) > 1 else None
-            self._checkout_and_clean(revision, branch)
+        # These are computed lazily by spawning git, so remember them for the
+        # remainder of this invocation.
+        self._cached_buck_version_uid = None
+        self._cached_fake_buck_version = None
+        self._cached_git_revision = None
+        self._known_revisions = {}
+        self._cat_file_process = None
+        self._cached_git_commit_timestamp = None
+        self._cached_has_local_changes = None
+        self._cached_is_dirty = None
 
-        self._build()
+        buck_version = buck_project.buck_version
+        try:
+            if self._is_git and not buck_project.has_no_buck_check and buck_version:
+                revision = buck_version[0]
+                branch = buck_version[1] if len(buck_version) > 1 else None
+                self._checkout_and_clean(revision, branch)
+
+            self._build()
+        except Exception:
+            # __exit__ won't run if construction fails (e.g. on RestartBuck).
+            self._close_cat_file_process()
+            raise
 
     def _checkout_and_clean(self, revision, branch):
         with Tracing('BuckRepo._checkout_and_clean'):
-            if not self._revision_exists(revision):
-                print(textwrap.dedent("""\
-                    Required revision {0} is not
-                    available in the local repository.
-                    Buck is fetching updates from git. You can disable this by creating
-                    a '.nobuckcheck' file in your repository, but this might lead to
-                    strange bugs or build failures.""".format(revision)),
-                      file=sys.stderr)
+            self._git_probe(revision)
+            revision_exists = self._revision_exists(revision)
+            # HEAD is known now too, so don't keep git running alongside the
+            # fetch, checkout and ant processes below.
+            self._close_cat_file_process()
+            if not revision_exists:
+                print(_MSG_REVISION_MISSING.format(revision), file=sys.stderr)
                 git_command = ['git', 'fetch']
                 git_command.extend(['--all'] if not branch else ['origin', branch])
                 try:
@@ -91,64 +216,147 @@ class BuckRepo(BuckTool):
                         stdout=sys.stderr,
                         cwd=self._buck_dir)
                 except subprocess.CalledProcessError:
-                    raise BuckToolException(textwrap.dedent("""\
-                          Failed to fetch Buck updates from git."""))
+                    raise BuckToolException(_MSG_FETCH_FAILED)
 
             current_revision = self._get_git_revision()
 
             if current_revision != revision:
-                print(textwrap.dedent("""\
-                    Buck is at {0}, but should be {1}.
-                    Buck is updating itself. To disable this, add a '.nobuckcheck'
-                    file to your project root. In general, you should only disable
-                    this if you are developing Buck.""".format(
-                    current_revision, revision)),
-                    file=sys.stderr)
+                print(_MSG_UPDATING.format(current_revision, revision), file=sys.stderr)
 
                 try:
                     subprocess.check_call(
                         ['git', 'checkout', '--quiet', revision],
                         cwd=self._buck_dir)
                 except subprocess.CalledProcessError:
-                    raise BuckToolException(textwrap.dedent("""\
-                          Failed to update Buck to revision {0}.""".format(revision)))
-                if os.path.exists(self._build_success_file):
-                    os.remove(self._build_success_file)
+                    raise BuckToolException(_MSG_CHECKOUT_FAILED.format(revision))
+                if self._is_built:
+                    try:
+                        os.remove(self._build_success_file)
+                    except OSError:
+                        pass
 
                 ant = self._check_for_ant()
                 self._run_ant_clean(ant)
                 raise RestartBuck()
 
     def _join_buck_dir(self, relative_path):
-        return os.path.join(self._buck_dir, *(relative_path.split('/')))
+        path = self._buck_dir_paths.get(relative_path)
+        if path is None:
+            path = os.path.join(self._buck_dir, *(relative_path.split('/')))
+            self._buck_dir_paths[relative_path] = path
+        return path
 
     def _has_local_changes(self):
         if not self._is_git:
             return False
-
-        output = check_output(
-            ['git', 'ls-files', '-m'],
-            cwd=self._buck_dir)
-        return bool(output.strip())
+        if self._cached_has_local_changes is None:
+            # The exit code alone tells us whether anything changed, without
+            # having git enumerate the modified files. diff-index trusts the
+            # stat info in the index; by the time we get here _is_dirty's
+            # `git status` has already refreshed it.
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call(
+                    ['git', 'diff-index', '--quiet', 'HEAD', '--'],
+                    cwd=self._buck_dir,
+                    stdout=devnull,
+                    stderr=devnull)
+            self._cached_has_local_changes = returncode != 0
+        return self._cached_has_local_changes
 
     def _get_git_revision(self):
         if not self._is_git:
             return 'N/A'
-        return buck_version.get_git_revision(self._buck_dir)
+        if self._cached_git_revision is None and 'HEAD' not in self._known_revisions:
+            self._git_probe()
+            # Nothing asks git for more once HEAD is known, so don't keep it
+            # running until __exit__.
+            self._close_cat_file_process()
+        if self._cached_git_revision is None:
+            self._cached_git_revision = buck_version.get_git_revision(self._buck_dir)
+        return self._cached_git_revision
+
+    def _is_dirty(self):
+        if self._cached_is_dirty is None:
+            if self._is_buck_repo_dirty_override == "1":
+                self._cached_is_dirty = True
+            elif self._is_git:
+                self._cached_is_dirty = buck_version.is_work_tree_dirty(self._buck_dir)
+            else:
+                # Worktrees and submodules have a .git file rather than a
+                # directory, so let buck_version look for a work tree itself.
+                self._cached_is_dirty = buck_version.is_dirty(self._buck_dir)
+        return self._cached_is_dirty
 
     def _get_git_commit_timestamp(self):
         if self._is_buck_repo_dirty_override or not self._is_git:
             return -1
-        return buck_version.get_git_revision_timestamp(self._buck_dir)
+        if self._cached_git_commit_timestamp is None:
+            self._cached_git_commit_timestamp = \
+                buck_version.get_git_revision_timestamp(self._buck_dir)
+        return self._cached_git_commit_timestamp
+
+    def _get_cat_file_process(self):
+        # A single 'git cat-file --batch-check' answers every revision probe
+        # made by this BuckRepo over its stdin/stdout. That costs one short
+        # lived git process when there is only one probe, but saves a spawn
+        # for each additional one; the process is shut down in __exit__.
+        if self._cat_file_process is None:
+            with open(os.devnull, 'w') as devnull:
+                self._cat_file_process = subprocess.Popen(
+                    ['git', 'cat-file', '--batch-check'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=devnull,
+                    cwd=self._buck_dir,
+                    bufsize=1,
+                    universal_newlines=True)
+            _set_close_on_exec(self._cat_file_process.stdin)
+            _set_close_on_exec(self._cat_file_process.stdout)
+        return self._cat_file_process
+
+    def _close_cat_file_process(self):
+        if self._cat_file_process is not None:
+            try:
+                self._cat_file_process.stdin.close()
+            except (IOError, OSError):
+                # git already exited, and the pipe broke under unflushed input.
+                pass
+            self._cat_file_process.wait()
+            self._cat_file_process.stdout.close()
+            self._cat_file_process = None
+
+    def _git_probe(self, *revisions):
+        """Resolve HEAD and the given revisions with the cat-file process.
+
+        If git fails (e.g. a corrupt .git, or it refuses to use the repository)
+        every name is recorded as missing, leaving HEAD to be resolved by
+        buck_version.get_git_revision.
+        """
+        names = ('HEAD',) + revisions
+        try:
+            process = self._get_cat_file_process()
+            process.stdin.write(''.join(name + '\n' for name in names))
+            process.stdin.flush()
+            lines = [process.stdout.readline() for name in names]
+            failed = process.poll() is not None or not all(lines)
+        except (IOError, OSError):
+            failed = True
+        if failed:
+            self._close_cat_file_process()
+            lines = [''] * len(names)
+        for name, line in zip(names, lines):
+            object_name = _parse_batch_check_line(line)
+            self._known_revisions[name] = object_name is not None
+            if name == 'HEAD' and object_name is not None:
+                self._cached_git_revision = object_name
 
     def _revision_exists(self, revision):
-        returncode = subprocess.call(
-            ['git', 'cat-file', '-e', revision],
-            cwd=self._buck_dir)
-        return returncode == 0
+        if revision not in self._known_revisions:
+            self._git_probe(revision)
+        return self._known_revisions.get(revision, False)
 
     def _check_for_ant(self):
-        ant = which('ant')
+        ant = _which_cached('ant')
         if not ant:
             message = "You do not have ant on your $PATH. Cannot build Buck."
             if sys.platform == "darwin":
@@ -157,47 +365,48 @@ class BuckRepo(BuckTool):
         return ant
 
     def _print_ant_failure_and_exit(self, ant_log_path):
-        print(textwrap.dedent("""\
-                ::: 'ant' failed in the buck repo at '{0}',
-                ::: and 'buck' is not properly built. It will be unusable
-                ::: until the error is corrected. You can check the logs
-                ::: at {1} to figure out what broke.""".format(
-              self._buck_dir, ant_log_path)), file=sys.stderr)
+        print(_MSG_ANT_FAILED.format(self._buck_dir, ant_log_path), file=sys.stderr)
         if self._is_git:
-            raise BuckToolException(textwrap.dedent("""\
-                ::: It is possible that running this command will fix it:
-                ::: git -C "{0}" clean -xfd""".format(self._buck_dir)))
+            raise BuckToolException(_MSG_FIX_WITH_GIT_CLEAN.format(self._buck_dir))
         else:
-            raise BuckToolException(textwrap.dedent("""\
-                ::: It is possible that running this command will fix it:
-                ::: rm -rf "{0}"/build""".format(self._buck_dir)))
+            raise BuckToolException(_MSG_FIX_WITH_RM_BUILD.format(self._buck_dir))
+
+    def _get_ant_env(self):
+        if self._ant_env is None:
+            self._ant_env = get_ant_env(JAVA_MAX_HEAP_SIZE_MB)
+        return self._ant_env
+
+    def _run_ant_with_log(self, command, log_path):
+        # ant inherits the log's file descriptor and writes to it directly,
+        # so nothing sits in a Python buffer: the log already fills in as
+        # ant runs and keeps everything ant wrote if it crashes.
+        with open(log_path, 'w') as log:
+            return subprocess.call(
+                command,
+                stdout=log,
+                cwd=self._buck_dir,
+                env=self._get_ant_env())
 
     def _run_ant_clean(self, ant):
         clean_log_path = os.path.join(self._buck_project.get_buck_out_log_dir(), 'ant-clean.log')
-        with open(clean_log_path, 'w') as clean_log:
-            exitcode = subprocess.call([ant, 'clean'], stdout=clean_log,
-                                       cwd=self._buck_dir, env=get_ant_env(JAVA_MAX_HEAP_SIZE_MB))
-            if exitcode is not 0:
-                self._print_ant_failure_and_exit(clean_log_path)
+        exitcode = self._run_ant_with_log([ant, 'clean'], clean_log_path)
+        if exitcode != 0:
+            self._print_ant_failure_and_exit(clean_log_path)
 
     def _run_ant(self, ant):
         ant_log_path = os.path.join(self._buck_project.get_buck_out_log_dir(), 'ant.log')
-        with open(ant_log_path, 'w') as ant_log:
-            exitcode = subprocess.call([ant], stdout=ant_log,
-                                       cwd=self._buck_dir, env=get_ant_env(JAVA_MAX_HEAP_SIZE_MB))
-            if exitcode is not 0:
-                self._print_ant_failure_and_exit(ant_log_path)
+        exitcode = self._run_ant_with_log([ant], ant_log_path)
+        if exitcode != 0:
+            self._print_ant_failure_and_exit(ant_log_path)
 
     def _build(self):
         with Tracing('BuckRepo._build'):
-            if not os.path.exists(self._build_success_file):
-                print(
-                    "Buck does not appear to have been built -- building Buck!",
-                    file=sys.stderr)
+            if not self._is_built:
+                sys.stderr.write("Buck does not appear to have been built -- building Buck!\n")
                 ant = self._check_for_ant()
                 self._run_ant_clean(ant)
                 self._run_ant(ant)
-                print("All done, continuing with build.", file=sys.stderr)
+                sys.stderr.write("All done, continuing with build.\n")
 
     def _get_resource_lock_path(self):
         return None
@@ -206,33 +415,55 @@ class BuckRepo(BuckTool):
         return True
 
     def _get_resource(self, resource, exe=False):
-        return self._join_buck_dir(RESOURCES[resource.name])
+        return os.path.join(self._buck_dir, *_RESOURCES_SPLIT[resource.name])
 
     def _get_buck_version_uid(self):
-        with Tracing('BuckRepo._get_buck_version_uid'):
+        if self._cached_buck_version_uid is None:
+            self._cached_buck_version_uid = self._compute_buck_version_uid()
+        return self._cached_buck_version_uid
 
+    def _get_fake_buck_version(self):
+        if self._cached_fake_buck_version is None:
             # Check if the developer has requested that we impersonate some other version.
             # Start with the environment variable BUCK_FAKE_VERSION.
-            fake_buck_version = os.environ.get('BUCK_FAKE_VERSION')
-            if not fake_buck_version:
+            fake_buck_version = os.environ.get('BUCK_FAKE_VERSION', '')
+            if not fake_buck_version and self._may_have_fake_buck_version_file:
                 # Then check the content of .fakebuckversion.
                 fake_buck_version_file_path = os.path.join(self._buck_dir, ".fakebuckversion")
-                if os.path.exists(fake_buck_version_file_path):
+                try:
                     with open(fake_buck_version_file_path) as fake_buck_version_file:
                         fake_buck_version = fake_buck_version_file.read().strip()
+                except IOError:
+                    pass
+            self._cached_fake_buck_version = fake_buck_version
+        return self._cached_fake_buck_version
 
+    def _compute_buck_version_uid(self):
+        with Tracing('BuckRepo._get_buck_version_uid'):
+            fake_buck_version = self._get_fake_buck_version()
             if fake_buck_version:
-                print(textwrap.dedent("""\
-                ::: Faking buck version {}, despite your buck directory not being that version."""
-                      .format(fake_buck_version)),
-                      file=sys.stderr)
+                sys.stderr.write(
+                    "::: Faking buck version " + fake_buck_version +
+                    ", despite your buck directory not being that version.\n")
                 return fake_buck_version
 
+            # BUCK_REPOSITORY_DIRTY=1 means we're asked to use the current
+            # revision no matter what state the working copy is in, which we
+            # may already know without asking git again.
+            if self._is_buck_repo_dirty_override == "1" and self._is_git:
+                return self._get_git_revision()
+
             # First try to get the "clean" buck version.  If it succeeds,
-            # return it.
-            clean_version = buck_version.get_clean_buck_version(
-                self._buck_dir,
-                allow_dirty=self._is_buck_repo_dirty_override == "1")
+            # return it. In a git checkout this reuses the revision and dirty
+            # state that the java args need as well.
+            if not self._is_git:
+                clean_version = buck_version.get_clean_buck_version(
+                    self._buck_dir,
+                    allow_dirty=self._is_buck_repo_dirty_override == "1")
+            elif not self._is_dirty():
+                clean_version = self._get_git_revision()
+            else:
+                clean_version = None
             if clean_version is not None:
                 return clean_version
 
@@ -243,24 +474,18 @@ class BuckRepo(BuckTool):
                 return buck_version.get_dirty_buck_version(self._buck_dir)
 
             if self._has_local_changes():
-                print(textwrap.dedent("""\
-                ::: Your buck directory has local modifications, and therefore
-                ::: builds will not be able to use a distributed cache.
-                ::: The following files must be either reverted or committed:"""),
-                      file=sys.stderr)
+                sys.stderr.write(_MSG_LOCAL_MODIFICATIONS + "\n")
+                # List the same changes _has_local_changes detected, staged
+                # ones included.
                 subprocess.call(
-                    ['git', 'ls-files', '-m'],
+                    ['git', 'diff-index', '--name-only', 'HEAD', '--'],
                     stdout=sys.stderr,
                     cwd=self._buck_dir)
             elif os.environ.get('BUCK_CLEAN_REPO_IF_DIRTY') != 'NO':
-                print(textwrap.dedent("""\
-                ::: Your local buck directory is dirty, and therefore builds will
-                ::: not be able to use a distributed cache."""), file=sys.stderr)
-                if sys.stdout.isatty():
-                    print(
-                        "::: Do you want to clean your buck directory? [y/N]",
-                        file=sys.stderr)
-                    choice = raw_input().lower()
+                sys.stderr.write(_MSG_DIRTY + "\n")
+                if sys.stdout.isatty() and sys.stdin.isatty():
+                    sys.stderr.write("::: Do you want to clean your buck directory? [y/N]\n")
+                    choice = _read_input().lower()
                     if choice == "y":
                         subprocess.call(
                             ['git', 'clean', '-fd'],
@@ -279,9 +504,7 @@ class BuckRepo(BuckTool):
                 "-Dbuck.git_commit={0}".format(self._get_buck_version_uid()),
                 "-Dbuck.git_commit_timestamp={0}".format(
                     self._get_git_commit_timestamp()),
-                "-Dbuck.git_dirty={0}".format(
-                  int(self._is_buck_repo_dirty_override == "1" or
-                      buck_version.is_dirty(self._buck_dir))),
+                "-Dbuck.git_dirty={0}".format(int(self._is_dirty())),
             ]
 
     def _get_bootstrap_classpath(self):
@@ -289,18 +512,16 @@ class BuckRepo(BuckTool):
 
     def _get_java_classpath(self):
         classpath_file_path = os.path.join(self._buck_dir, "programs", "classpaths")
-        classpath_entries = []
         with open(classpath_file_path, 'r') as classpath_file:
-            for line in classpath_file.readlines():
-                line = line.strip()
-                if line.startswith('#'):
-                    continue
-                classpath_entries.append(line)
-        return self._pathsep.join([self._join_buck_dir(p) for p in classpath_entries])
+            classpath_entries = [
+                self._join_buck_dir(entry)
+                for entry in (line.strip() for line in classpath_file)
+                if entry and not entry.startswith('#')]
+        return self._pathsep.join(classpath_entries)
 
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self._close_cat_file_process()
@@ -50,15 +50,19 @@ def is_git(dirpath):
 
 
 def is_dirty(dirpath):
+    if not is_git(dirpath):
+        return False
+    return is_work_tree_dirty(dirpath)
+
+
+def is_work_tree_dirty(dirpath):
+    """Like is_dirty, for a `dirpath` already known to be a git work tree."""
     # Ignore any changes under these paths for the purposes of forcing a rebuild
     # of Buck itself.
     IGNORE_PATHS = ['test']
     IGNORE_PATHS_RE_GROUP = '|'.join([re.escape(e) for e in IGNORE_PATHS])
     IGNORE_PATHS_RE = re.compile('^.. (?:' + IGNORE_PATHS_RE_GROUP + ')')
 
-    if not is_git(dirpath):
-        return False
-
     output = check_output(
         ['git', 'status', '--porcelain'],
         cwd=dirpath)
@@ -0,0 +1,224 @@
+# Copyright 2016-present Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from buck_repo import BuckRepo, get_ant_env, _inspect_buck_dir, _parse_batch_check_line
+from subprocutils import check_output, which
+
+
+class FakeBuckProject(object):
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.buck_version = None
+        self.has_no_buck_check = True
+
+
+class TestGetAntEnv(unittest.TestCase):
+    def setUp(self):
+        self.ant_opts = os.environ.pop('ANT_OPTS', None)
+
+    def tearDown(self):
+        os.environ.pop('ANT_OPTS', None)
+        if self.ant_opts is not None:
+            os.environ['ANT_OPTS'] = self.ant_opts
+
+    def test_uses_environment_as_is_when_max_heap_is_set(self):
+        os.environ['ANT_OPTS'] = '-Xmx2g'
+        self.assertIs(get_ant_env(1000), os.environ)
+
+    def test_appends_max_heap_to_existing_options(self):
+        os.environ['ANT_OPTS'] = '-Dfoo=bar'
+        env = get_ant_env(1000)
+        self.assertIsNot(env, os.environ)
+        self.assertEqual(env['ANT_OPTS'], '-Dfoo=bar -Xmx1000m')
+        self.assertEqual(os.environ['ANT_OPTS'], '-Dfoo=bar')
+
+    def test_sets_max_heap_without_existing_options(self):
+        self.assertEqual(get_ant_env(1000)['ANT_OPTS'], '-Xmx1000m')
+        self.assertNotIn('ANT_OPTS', os.environ)
+
+
+class TestParseBatchCheckLine(unittest.TestCase):
+    def test_existing_object(self):
+        sha = 'a' * 40
+        self.assertEqual(_parse_batch_check_line(sha + ' commit 230\n'), sha)
+
+    def test_missing_object(self):
+        self.assertIsNone(_parse_batch_check_line('deadbeef missing\n'))
+
+    def test_ambiguous_object(self):
+        self.assertIsNone(_parse_batch_check_line('abc ambiguous\n'))
+
+    def test_no_output(self):
+        self.assertIsNone(_parse_batch_check_line(''))
+
+
+class TestInspectBuckDir(unittest.TestCase):
+    def setUp(self):
+        self.buck_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.buck_dir)
+
+    def test_empty_directory(self):
+        self.assertEqual(_inspect_buck_dir(self.buck_dir), (False, False, True))
+
+    def test_built_checkout(self):
+        os.makedirs(os.path.join(self.buck_dir, '.git'))
+        os.makedirs(os.path.join(self.buck_dir, 'build'))
+        open(os.path.join(self.buck_dir, 'build', 'successful-build'), 'w').close()
+        self.assertEqual(_inspect_buck_dir(self.buck_dir), (True, True, True))
+
+    def test_dot_git_file_is_not_a_checkout(self):
+        open(os.path.join(self.buck_dir, '.git'), 'w').close()
+        self.assertFalse(_inspect_buck_dir(self.buck_dir)[0])
+
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(cwd, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['git'] + list(args), cwd=cwd, env=GIT_ENV,
+                              stdout=devnull, stderr=devnull)
+
+
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.buck_dir = tempfile.mkdtemp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.make_buck_dir(self.buck_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.buck_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def make_buck_dir(self, buck_dir):
+        os.makedirs(os.path.join(buck_dir, 'bin'))
+        os.makedirs(os.path.join(buck_dir, 'build'))
+        open(os.path.join(buck_dir, 'build', 'successful-build'), 'w').close()
+
+    def make_repo(self, buck_dir=None):
+        return BuckRepo(os.path.join(buck_dir or self.buck_dir, 'bin'),
+                        FakeBuckProject(self.tmp_dir))
+
+    def commit(self):
+        with open(os.path.join(self.buck_dir, '.gitignore'), 'w') as gitignore:
+            gitignore.write('build/\n')
+        git(self.buck_dir, 'init')
+        git(self.buck_dir, 'add', '.gitignore')
+        git(self.buck_dir, 'commit', '-m', 'test')
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=self.buck_dir).strip()
+
+
+@unittest.skipUnless(which('git'), 'git is not available')
+class TestGitProbe(GitTestCase):
+    def test_resolves_head_and_revisions(self):
+        head = self.commit()
+        with self.make_repo() as repo:
+            self.assertTrue(repo._revision_exists(head))
+            self.assertFalse(repo._revision_exists('0' * 40))
+            self.assertEqual(repo._get_git_revision(), head)
+
+    def test_git_exiting_at_startup(self):
+        # git refuses to work with an empty .git directory.
+        os.makedirs(os.path.join(self.buck_dir, '.git'))
+        with self.make_repo() as repo:
+            self.assertFalse(repo._revision_exists('HEAD'))
+            self.assertIsNone(repo._cat_file_process)
+
+    def test_git_exiting_at_startup_with_unwritable_input(self):
+        # Enough input to fill the pipe, so writing it fails once git exits.
+        os.makedirs(os.path.join(self.buck_dir, '.git'))
+        with self.make_repo() as repo:
+            self.assertFalse(repo._revision_exists('x' * 1000000))
+            self.assertIsNone(repo._cat_file_process)
+
+
+@unittest.skipUnless(which('git'), 'git is not available')
+class TestBuckVersionUid(GitTestCase):
+    def setUp(self):
+        super(TestBuckVersionUid, self).setUp()
+        self.saved_env = dict(
+            (name, os.environ.pop(name, None))
+            for name in ('BUCK_REPOSITORY_DIRTY', 'BUCK_FAKE_VERSION'))
+        self.head = self.commit()
+
+    def tearDown(self):
+        for name, value in self.saved_env.items():
+            os.environ.pop(name, None)
+            if value is not None:
+                os.environ[name] = value
+        super(TestBuckVersionUid, self).tearDown()
+
+    def make_dirty_worktree(self):
+        # A worktree has a .git file rather than a directory.
+        worktree = os.path.join(self.tmp_dir, 'worktree')
+        git(self.buck_dir, 'worktree', 'add', worktree, 'HEAD')
+        self.make_buck_dir(worktree)
+        with open(os.path.join(worktree, 'dirty'), 'w') as dirty:
+            dirty.write('dirty\n')
+        return worktree
+
+    def get_uid_and_dirty(self, buck_dir=None):
+        with self.make_repo(buck_dir) as repo:
+            java_args = repo._get_extra_java_args()
+            return repo._get_buck_version_uid(), java_args[-1]
+
+    def test_clean_checkout(self):
+        self.assertEqual(self.get_uid_and_dirty(), (self.head, '-Dbuck.git_dirty=0'))
+
+    def test_dirty_checkout(self):
+        open(os.path.join(self.buck_dir, 'dirty'), 'w').close()
+        uid, git_dirty = self.get_uid_and_dirty()
+        self.assertNotEqual(uid, self.head)
+        self.assertEqual(git_dirty, '-Dbuck.git_dirty=1')
+
+    def test_dirty_checkout_with_override(self):
+        open(os.path.join(self.buck_dir, 'dirty'), 'w').close()
+        os.environ['BUCK_REPOSITORY_DIRTY'] = '1'
+        self.assertEqual(self.get_uid_and_dirty(), (self.head, '-Dbuck.git_dirty=1'))
+
+    def test_override_skips_dirty_check(self):
+        os.environ['BUCK_REPOSITORY_DIRTY'] = '1'
+        with self.make_repo() as repo:
+            self.assertEqual(repo._get_buck_version_uid(), self.head)
+            self.assertIsNone(repo._cached_is_dirty)
+            self.assertIsNone(repo._cached_has_local_changes)
+
+    def test_closes_git_once_version_is_known(self):
+        with self.make_repo() as repo:
+            repo._get_extra_java_args()
+            self.assertIsNone(repo._cat_file_process)
+
+    def test_dirty_worktree(self):
+        uid, git_dirty = self.get_uid_and_dirty(self.make_dirty_worktree())
+        self.assertNotEqual(uid, self.head)
+        self.assertEqual(git_dirty, '-Dbuck.git_dirty=1')
+
+    def test_dirty_worktree_with_override(self):
+        worktree = self.make_dirty_worktree()
+        os.environ['BUCK_REPOSITORY_DIRTY'] = '1'
+        self.assertEqual(self.get_uid_and_dirty(worktree), (self.head, '-Dbuck.git_dirty=1'))
+
+
+if __name__ == '__main__':
+    unittest.main()